@@ -1,3 +1,27 @@
 from django.contrib import admin
+from .models import RegistroAuditoria, EsperaCita
 
-# Register your models here.
+
+@admin.register(RegistroAuditoria)
+class RegistroAuditoriaAdmin(admin.ModelAdmin):
+    list_display = ('fecha', 'modelo', 'objeto_id', 'accion', 'usuario_nombre')
+    list_filter = ('modelo', 'accion')
+    search_fields = ('usuario_nombre',)
+    readonly_fields = ('modelo', 'objeto_id', 'accion', 'usuario', 'usuario_nombre', 'cambios', 'fecha')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(EsperaCita)
+class EsperaCitaAdmin(admin.ModelAdmin):
+    list_display = ('creada', 'paciente', 'medico', 'especialidad', 'prioridad', 'estado')
+    list_filter = ('estado', 'prioridad', 'especialidad')
+    list_select_related = ('paciente', 'medico')
+    raw_id_fields = ('cita',)
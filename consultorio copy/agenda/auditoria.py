@@ -0,0 +1,211 @@
+import atexit
+import contextvars
+import datetime
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+# Auditoria asincrona de cambios en registros clinicos.
+#
+# Las señales arman el registro (diff antes/despues y usuario) en el hilo de
+# la peticion y lo dejan en una cola en memoria; un hilo en segundo plano lo
+# guarda en lotes con bulk_create. Asi la peticion no espera ningun INSERT.
+
+TAMANO_LOTE = getattr(settings, 'AGENDA_AUDITORIA_LOTE', 200)
+INTERVALO_VACIADO = getattr(settings, 'AGENDA_AUDITORIA_INTERVALO', 2)
+
+_FIN = object()
+_cola = queue.Queue()
+_hilo = None
+_candado = threading.Lock()
+
+# Peticion en curso, la pone AuditoriaMiddleware. Se guarda la peticion y no
+# request.user: asgiref compara los valores de las contextvars al restaurar el
+# contexto y eso cargaria el usuario (consulta a la base) desde codigo async.
+peticion_actual = contextvars.ContextVar('peticion_actual', default=None)
+
+
+def _usuario():
+    request = peticion_actual.get()
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated:
+        return None, ''
+    return user.pk, user.get_username()
+
+
+def _guardar(registros):
+    from .models import RegistroAuditoria
+    # Todo el lote o nada, para poder reintentarlo sin duplicar.
+    with transaction.atomic():
+        RegistroAuditoria.objects.bulk_create(registros, batch_size=TAMANO_LOTE)
+
+
+def _guardar_de_a_uno(registros):
+    for registro in registros:
+        try:
+            _guardar([registro])
+        except IntegrityError:
+            if registro.usuario_id is None:
+                logger.exception("Se descarta un registro de auditoria invalido: %s", registro)
+                continue
+            # El usuario se borro antes de guardar el registro: queda su nombre.
+            registro.usuario_id = None
+            _guardar_de_a_uno([registro])
+
+
+def _trabajar():
+    while True:
+        lote = []
+        fin = False
+        try:
+            elemento = _cola.get(timeout=INTERVALO_VACIADO)
+        except queue.Empty:
+            continue
+        while True:
+            if elemento is _FIN:
+                fin = True
+                break
+            lote.append(elemento)
+            if len(lote) >= TAMANO_LOTE:
+                break
+            try:
+                elemento = _cola.get_nowait()
+            except queue.Empty:
+                break
+        if lote:
+            try:
+                _guardar(lote)
+            except IntegrityError:
+                # Un registro invalido (p. ej. de un usuario ya borrado) no
+                # debe bloquear a los demas: se guardan de a uno.
+                _guardar_de_a_uno(lote)
+            except Exception:
+                # No se pierde el lote: se vuelve a encolar para el siguiente intento.
+                for registro in lote:
+                    _cola.put(registro)
+                time.sleep(INTERVALO_VACIADO)
+            finally:
+                close_old_connections()
+        if fin:
+            return
+
+
+def _iniciar_hilo():
+    global _hilo
+    with _candado:
+        if _hilo is None or not _hilo.is_alive():
+            _hilo = threading.Thread(target=_trabajar, name='agenda-auditoria', daemon=True)
+            _hilo.start()
+
+
+def registrar(instance, accion, cambios):
+    from .models import RegistroAuditoria
+    usuario_id, usuario_nombre = _usuario()
+    registro = RegistroAuditoria(
+        modelo=instance._meta.label_lower,
+        objeto_id=instance.pk,
+        accion=accion,
+        usuario_id=usuario_id,
+        usuario_nombre=usuario_nombre,
+        cambios=cambios,
+        fecha=timezone.now(),
+    )
+    # Si la transaccion se revierte, el cambio no ocurrio y no se audita.
+    transaction.on_commit(lambda: _encolar(registro))
+
+
+def _encolar(registro):
+    # AGENDA_AUDITORIA_SINCRONA guarda en el momento, sin hilo (util en pruebas).
+    if getattr(settings, 'AGENDA_AUDITORIA_SINCRONA', False):
+        _guardar([registro])
+        return
+    _iniciar_hilo()
+    _cola.put(registro)
+
+
+def vaciar():
+    """Guarda de inmediato, en el hilo actual, todo lo que siga en la cola."""
+    pendientes = []
+    while True:
+        try:
+            elemento = _cola.get_nowait()
+        except queue.Empty:
+            break
+        if elemento is not _FIN:
+            pendientes.append(elemento)
+    if pendientes:
+        _guardar(pendientes)
+
+
+@atexit.register
+def detener():
+    global _hilo
+    with _candado:
+        hilo, _hilo = _hilo, None
+    if hilo is not None and hilo.is_alive():
+        _cola.put(_FIN)
+        hilo.join()
+    # Lo que quedara (p. ej. un lote que fallo al final) se guarda aqui.
+    try:
+        vaciar()
+    except Exception:
+        logger.exception("No se pudieron guardar los registros de auditoria pendientes")
+
+
+# Diff de campos
+
+def _normalizar(campo, valor):
+    # Las vistas asignan ids como texto y fechas sin zona horaria; se comparan
+    # tal como quedan guardados para no registrar cambios falsos.
+    valor = campo.to_python(valor)
+    if isinstance(valor, datetime.datetime) and settings.USE_TZ and timezone.is_naive(valor):
+        valor = timezone.make_aware(valor)
+    return valor
+
+
+def valores(instance, campos):
+    # Valores crudos, sin normalizar: se toma en cada post_init, asi que debe
+    # ser barato. Solo lee lo que ya esta cargado para no disparar consultas
+    # en campos diferidos.
+    return {campo: instance.__dict__[campo] for campo in campos if campo in instance.__dict__}
+
+
+def normalizados(instance, valores):
+    return {
+        campo: _normalizar(instance._meta.get_field(campo), valor)
+        for campo, valor in valores.items()
+    }
+
+
+def instantanea(instance, campos):
+    return normalizados(instance, valores(instance, campos))
+
+
+def diferencias(antes, despues):
+    return {
+        campo: [antes.get(campo), valor]
+        for campo, valor in despues.items()
+        if antes.get(campo) != valor
+    }
+
+
+# Consultas (usan los indices de RegistroAuditoria)
+
+def historial(instance):
+    from .models import RegistroAuditoria
+    return RegistroAuditoria.objects.filter(
+        modelo=instance._meta.label_lower, objeto_id=instance.pk
+    ).order_by('-fecha')
+
+
+def acciones_de(usuario):
+    from .models import RegistroAuditoria
+    return RegistroAuditoria.objects.filter(usuario=usuario).order_by('-fecha')
@@ -0,0 +1,154 @@
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from .models import Cita
+
+
+# Busqueda de texto completo sobre Cita.motivo y Cita.notas_atencion.
+#
+# Cada motor sabe mantener su indice y devolver ids de citas ordenados por
+# relevancia. Se elige segun la base de datos en uso (o con el setting
+# AGENDA_BUSQUEDA_MOTOR):
+#   - sqlite:    tabla virtual FTS5 agenda_cita_fts, sincronizada desde las señales.
+#   - microsoft: indice FULLTEXT de SQL Server sobre agenda_cita (se actualiza solo),
+#                si existe; si no, se usa el motor basico.
+#   - otras:     icontains, sin indice (recorre toda la tabla).
+
+LIMITE_RESULTADOS = 200
+
+
+def terminos(consulta):
+    # Solo palabras: el texto del usuario nunca llega crudo a la sintaxis MATCH/CONTAINS.
+    return re.findall(r'\w+', consulta or '')
+
+
+def _filtros_sql(paciente_id, desde, hasta):
+    condiciones, parametros = [], []
+    if paciente_id is not None:
+        condiciones.append('c.paciente_id = %s')
+        parametros.append(paciente_id)
+    if desde is not None:
+        condiciones.append('c.fecha_hora >= %s')
+        parametros.append(connection.ops.adapt_datetimefield_value(desde))
+    if hasta is not None:
+        condiciones.append('c.fecha_hora < %s')
+        parametros.append(connection.ops.adapt_datetimefield_value(hasta))
+    return ''.join(' AND ' + condicion for condicion in condiciones), parametros
+
+
+class MotorBusqueda:
+    @classmethod
+    def disponible(cls):
+        return True
+
+    def indexar(self, cita):
+        pass
+
+    def eliminar(self, cita_id):
+        pass
+
+    def buscar(self, consulta, paciente_id=None, desde=None, hasta=None, limite=LIMITE_RESULTADOS):
+        raise NotImplementedError
+
+
+class MotorBasico(MotorBusqueda):
+    def buscar(self, consulta, paciente_id=None, desde=None, hasta=None, limite=LIMITE_RESULTADOS):
+        citas = Cita.objects.all()
+        for termino in terminos(consulta):
+            citas = citas.filter(Q(motivo__icontains=termino) | Q(notas_atencion__icontains=termino))
+        if paciente_id is not None:
+            citas = citas.filter(paciente_id=paciente_id)
+        if desde is not None:
+            citas = citas.filter(fecha_hora__gte=desde)
+        if hasta is not None:
+            citas = citas.filter(fecha_hora__lt=hasta)
+        return list(citas.order_by('-fecha_hora').values_list('id', flat=True)[:limite])
+
+
+class MotorFTS5(MotorBusqueda):
+    tabla = 'agenda_cita_fts'
+
+    def indexar(self, cita):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.tabla} WHERE rowid = %s', [cita.id])
+            cursor.execute(
+                f'INSERT INTO {self.tabla} (rowid, motivo, notas_atencion) VALUES (%s, %s, %s)',
+                [cita.id, cita.motivo, cita.notas_atencion],
+            )
+
+    def eliminar(self, cita_id):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.tabla} WHERE rowid = %s', [cita_id])
+
+    def buscar(self, consulta, paciente_id=None, desde=None, hasta=None, limite=LIMITE_RESULTADOS):
+        palabras = terminos(consulta)
+        if not palabras:
+            return []
+        # Cada palabra como prefijo: "dolor pecho" encuentra "dolores en el pecho".
+        expresion = ' '.join(f'"{palabra}"*' for palabra in palabras)
+        filtros, parametros = _filtros_sql(paciente_id, desde, hasta)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT {self.tabla}.rowid FROM {self.tabla} JOIN agenda_cita c ON c.id = {self.tabla}.rowid '
+                f'WHERE {self.tabla} MATCH %s{filtros} ORDER BY {self.tabla}.rank LIMIT %s',
+                [expresion, *parametros, limite],
+            )
+            return [fila[0] for fila in cursor.fetchall()]
+
+
+class MotorSQLServer(MotorBusqueda):
+    # El indice FULLTEXT usa CHANGE_TRACKING AUTO: SQL Server lo mantiene solo.
+
+    @classmethod
+    def disponible(cls):
+        # La migracion 0006 no crea el indice si el servidor no tiene Full-Text Search.
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*) FROM sys.fulltext_indexes WHERE object_id = OBJECT_ID('agenda_cita')")
+            return cursor.fetchone()[0] > 0
+
+    def buscar(self, consulta, paciente_id=None, desde=None, hasta=None, limite=LIMITE_RESULTADOS):
+        palabras = terminos(consulta)
+        if not palabras:
+            return []
+        expresion = ' AND '.join(f'"{palabra}*"' for palabra in palabras)
+        filtros, parametros = _filtros_sql(paciente_id, desde, hasta)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT TOP (%s) c.id FROM CONTAINSTABLE(agenda_cita, (motivo, notas_atencion), %s) f '
+                f'JOIN agenda_cita c ON c.id = f.[KEY] WHERE 1 = 1{filtros} ORDER BY f.RANK DESC',
+                [limite, expresion, *parametros],
+            )
+            return [fila[0] for fila in cursor.fetchall()]
+
+
+MOTORES = {
+    'sqlite': MotorFTS5,
+    'microsoft': MotorSQLServer,
+}
+
+_motor = None
+
+
+def obtener_motor():
+    global _motor
+    if _motor is None:
+        ruta = getattr(settings, 'AGENDA_BUSQUEDA_MOTOR', None)
+        if ruta:
+            _motor = import_string(ruta)()
+        else:
+            clase = MOTORES.get(connection.vendor, MotorBasico)
+            if not clase.disponible():
+                clase = MotorBasico
+            _motor = clase()
+    return _motor
+
+
+def buscar_citas(consulta, **filtros):
+    """Citas que coinciden con la consulta, ordenadas por relevancia."""
+    ids = obtener_motor().buscar(consulta, **filtros)
+    citas = Cita.objects.select_related('paciente', 'medico').in_bulk(ids)
+    return [citas[cita_id] for cita_id in ids if cita_id in citas]
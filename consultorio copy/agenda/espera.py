@@ -0,0 +1,92 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from .models import Cita, EsperaCita, Medico
+
+
+# Lista de espera y reasignacion automatica de horarios liberados.
+#
+# La base de datos es la unica fuente de verdad: al liberar un horario, con el
+# Medico bloqueado, el mejor candidato (prioridad desc, llegada asc) se elige
+# con dos consultas indexadas, una por medico (espera_medico_idx) y otra por
+# especialidad (espera_especialidad_idx). Cada una lee una sola fila, asi que
+# el costo no depende del largo de la lista de espera. Se saltan los pacientes
+# que ya tienen cita a esa hora (cita_paciente_fecha_idx).
+
+
+def _especialidad(texto):
+    return (texto or '').strip().lower()
+
+
+class MotorEspera:
+
+    def mejor_candidata(self, medico, fecha_hora, excluir_paciente=None):
+        """Mejor entrada en espera para un horario del medico, leida de la base."""
+        # Quien ya tiene otra cita a esa hora (p. ej. espera en dos especialidades) no es candidato.
+        ocupado = Cita.objects.filter(
+            paciente_id=OuterRef('paciente_id'), fecha_hora=fecha_hora
+        ).exclude(estado='cancelada')
+        esperando = EsperaCita.objects.filter(estado='esperando').exclude(Exists(ocupado))
+        if excluir_paciente is not None:
+            esperando = esperando.exclude(paciente_id=excluir_paciente)
+        orden = ('-prioridad', 'creada', 'id')
+        candidatas = [
+            entrada for entrada in (
+                esperando.filter(medico=medico).order_by(*orden).first(),
+                esperando.filter(
+                    medico__isnull=True, especialidad=_especialidad(medico.especialidad)
+                ).order_by(*orden).first(),
+            ) if entrada is not None
+        ]
+        return min(candidatas, key=lambda entrada: (-entrada.prioridad, entrada.creada, entrada.id), default=None)
+
+    def liberar(self, medico, fecha_hora, excluir_paciente=None):
+        """Agenda el horario liberado al mejor paciente en espera.
+
+        Se ejecuta dentro de la transaccion de la vista que libero el horario:
+        si algo falla, ni la baja ni la nueva cita quedan guardadas.
+        Devuelve la cita creada o None.
+        """
+        if timezone.is_naive(fecha_hora):
+            fecha_hora = timezone.make_aware(fecha_hora)
+        if fecha_hora <= timezone.now():
+            return None
+
+        with transaction.atomic():
+            # Serializa las reasignaciones del mismo medico entre procesos.
+            list(Medico.objects.select_for_update().filter(id=medico.id).values_list('id'))
+
+            if Cita.objects.filter(medico=medico, fecha_hora=fecha_hora).exclude(estado='cancelada').exists():
+                return None
+
+            while True:
+                entrada = self.mejor_candidata(medico, fecha_hora, excluir_paciente)
+                if entrada is None:
+                    return None
+
+                try:
+                    with transaction.atomic():
+                        tomada = EsperaCita.objects.filter(
+                            id=entrada.id, estado='esperando'
+                        ).update(estado='asignada')
+                        if not tomada:
+                            # El paciente la cancelo desde otro proceso.
+                            continue
+                        cita = Cita.objects.create(
+                            paciente_id=entrada.paciente_id,
+                            medico=medico,
+                            fecha_hora=fecha_hora,
+                            motivo=entrada.motivo or "Asignada desde la lista de espera",
+                        )
+                        entrada.estado = 'asignada'
+                        entrada.cita = cita
+                        entrada.save(update_fields=['estado', 'cita'])
+                except IntegrityError:
+                    # El horario se agendo desde otra vista (cita_medico_horario_unico).
+                    return None
+
+                return cita
+
+
+motor_espera = MotorEspera()
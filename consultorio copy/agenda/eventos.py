@@ -0,0 +1,110 @@
+import asyncio
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+# Eventos en vivo de la agenda (Server-Sent Events).
+#
+# Cada conexion abierta tiene su propia cola acotada dentro del event loop de
+# ASGI. Las señales de Cita publican en el bus configurado y el bus entrega
+# al difusor, que reparte el evento a todas las colas sin tocar la base de
+# datos. Una conexion inactiva solo cuesta su cola vacia y una corrutina
+# esperando.
+
+TAMANO_COLA = getattr(settings, 'AGENDA_EVENTOS_TAMANO_COLA', 100)
+INTERVALO_LATIDO = getattr(settings, 'AGENDA_EVENTOS_LATIDO', 15)
+
+# Evento que se entrega cuando un cliente se quedo atras y se descartaron
+# eventos: el navegador debe recargar la agenda completa.
+EVENTO_RESINCRONIZAR = {'accion': 'resincronizar'}
+
+
+class Suscripcion:
+    def __init__(self, loop, filtro=None, tamano=TAMANO_COLA):
+        self.loop = loop
+        self.filtro = filtro
+        self.cola = asyncio.Queue(maxsize=tamano)
+
+    def acepta(self, evento):
+        return self.filtro is None or self.filtro(evento)
+
+    def entregar(self, evento):
+        # Se ejecuta siempre dentro del loop de la suscripcion.
+        try:
+            self.cola.put_nowait(evento)
+        except asyncio.QueueFull:
+            # Contrapresion: un cliente lento no frena a los demas. Se vacia
+            # su cola y se le pide que se resincronice.
+            while not self.cola.empty():
+                self.cola.get_nowait()
+            self.cola.put_nowait(EVENTO_RESINCRONIZAR)
+
+
+class Difusor:
+    def __init__(self):
+        self._suscripciones = set()
+        self._candado = threading.Lock()
+
+    def suscribir(self, filtro=None):
+        suscripcion = Suscripcion(asyncio.get_running_loop(), filtro)
+        with self._candado:
+            self._suscripciones.add(suscripcion)
+        return suscripcion
+
+    def desuscribir(self, suscripcion):
+        with self._candado:
+            self._suscripciones.discard(suscripcion)
+
+    def cantidad(self):
+        return len(self._suscripciones)
+
+    def difundir(self, evento):
+        # Puede llamarse desde cualquier hilo (las vistas sincronas corren en
+        # hilos bajo ASGI), por eso la entrega se agenda en el loop de cada
+        # suscripcion.
+        with self._candado:
+            suscripciones = list(self._suscripciones)
+        for suscripcion in suscripciones:
+            if not suscripcion.acepta(evento):
+                continue
+            try:
+                suscripcion.loop.call_soon_threadsafe(suscripcion.entregar, evento)
+            except RuntimeError:
+                # El loop ya se cerro; la conexion murio sin desuscribirse.
+                self.desuscribir(suscripcion)
+
+
+difusor = Difusor()
+
+
+# Bus en proceso: entrega directamente al difusor local. Para varios procesos
+# se puede configurar AGENDA_EVENTOS_BUS con una clase que publique en un
+# servicio externo (Redis, Postgres NOTIFY...) y cuyos suscriptores llamen a
+# difusor.difundir() en cada proceso.
+class BusLocal:
+    def publicar(self, evento):
+        difusor.difundir(evento)
+
+
+_bus = None
+
+
+def obtener_bus():
+    global _bus
+    if _bus is None:
+        ruta = getattr(settings, 'AGENDA_EVENTOS_BUS', 'agenda.eventos.BusLocal')
+        _bus = import_string(ruta)()
+    return _bus
+
+
+def evento_cita(cita, accion):
+    return {
+        'accion': accion,
+        'id': cita.id,
+        'paciente_id': cita.paciente_id,
+        'medico_id': cita.medico_id,
+        'fecha_hora': cita.fecha_hora.isoformat() if cita.fecha_hora else None,
+        'estado': cita.estado,
+    }
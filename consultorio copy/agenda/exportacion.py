@@ -0,0 +1,223 @@
+import csv
+import gzip
+import io
+import json
+import zlib
+from collections import deque
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Cita
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Exportacion del historial de citas (con paciente y medico) para analitica.
+#
+# Se recorre la tabla por lotes con paginacion por clave (actualizada, id):
+# cada lote es una consulta acotada que usa cita_actualizada_idx, asi que la
+# memoria no depende del tamaño de la tabla. Se usa values_list() para no crear
+# instancias de modelo (ni disparar sus señales).
+
+TAMANO_LOTE = getattr(settings, 'AGENDA_EXPORTACION_LOTE', 5000)
+
+# actualizada es la hora del save(), no la del commit: una cita guardada antes
+# de que termine una exportacion pero confirmada despues queda con una marca
+# anterior. Las exportaciones incrementales releen este margen hacia atras y
+# descartan lo que ya exportaron. Debe superar la transaccion mas larga.
+MARGEN = timedelta(seconds=getattr(settings, 'AGENDA_EXPORTACION_MARGEN', 300))
+
+# (columna de salida, campo en la consulta)
+COLUMNAS = [
+    ('id', 'id'),
+    ('fecha_hora', 'fecha_hora'),
+    ('estado', 'estado'),
+    ('motivo', 'motivo'),
+    ('notas_atencion', 'notas_atencion'),
+    ('actualizada', 'actualizada'),
+    ('paciente_id', 'paciente_id'),
+    ('paciente_nombre', 'paciente__nombre'),
+    ('paciente_fecha_nacimiento', 'paciente__fecha_nacimiento'),
+    ('paciente_telefono', 'paciente__telefono'),
+    ('medico_id', 'medico_id'),
+    ('medico_nombre', 'medico__nombre'),
+    ('medico_especialidad', 'medico__especialidad'),
+]
+ENCABEZADOS = [columna for columna, _ in COLUMNAS]
+
+
+def fecha_con_zona(fecha):
+    if fecha is not None and timezone.is_naive(fecha):
+        fecha = timezone.make_aware(fecha)
+    return fecha
+
+
+def _consulta(desde=None):
+    citas = Cita.objects.all()
+    if desde is not None:
+        citas = citas.filter(actualizada__gte=desde)
+    return citas.order_by('actualizada', 'id').values_list(*[campo for _, campo in COLUMNAS])
+
+
+def contar(desde=None):
+    citas = Cita.objects.all()
+    if desde is not None:
+        citas = citas.filter(actualizada__gte=desde)
+    return citas.count()
+
+
+def leer_lote(desde=None, cursor=None, tamano=TAMANO_LOTE):
+    """Devuelve el siguiente lote de filas y el cursor para pedir el que sigue."""
+    filas = _consulta(desde)
+    if cursor is not None:
+        actualizada, ultimo_id = cursor
+        filas = filas.filter(Q(actualizada__gt=actualizada) | Q(actualizada=actualizada, id__gt=ultimo_id))
+    lote = list(filas[:tamano])
+    if not lote:
+        return lote, cursor
+    ultima = lote[-1]
+    return lote, (ultima[ENCABEZADOS.index('actualizada')], ultima[0])
+
+
+_ACTUALIZADA = ENCABEZADOS.index('actualizada')
+
+
+def iterar_lotes(desde=None, tamano=TAMANO_LOTE, vistas=None):
+    """Lotes de filas con actualizada >= desde, sin las versiones ya exportadas."""
+    cursor = None
+    while True:
+        lote, cursor = leer_lote(desde, cursor, tamano)
+        if not lote:
+            return
+        if vistas:
+            lote = [fila for fila in lote if (fila[0], fila[_ACTUALIZADA].isoformat()) not in vistas]
+        if lote:
+            yield lote
+
+
+class EstadoIncremental:
+    """Marca de la ultima exportacion y las filas exportadas dentro del margen."""
+
+    def __init__(self, marca=None, vistas=()):
+        self.marca = marca
+        self._recientes = deque(sorted((parse_datetime(fecha), id_) for id_, fecha in vistas))
+
+    @classmethod
+    def leer(cls, ruta):
+        datos = json.loads(ruta.read_text())
+        return cls(parse_datetime(datos['marca']), datos['vistas'])
+
+    def guardar(self, ruta):
+        ruta.write_text(json.dumps({
+            'marca': self.marca.isoformat(),
+            'vistas': [[id_, fecha.isoformat()] for fecha, id_ in self._recientes],
+        }))
+
+    @property
+    def desde(self):
+        return self.marca - MARGEN if self.marca else None
+
+    @property
+    def vistas(self):
+        return {(id_, fecha.isoformat()) for fecha, id_ in self._recientes}
+
+    def registrar(self, lote):
+        # Los lotes vienen ordenados por actualizada: solo se guarda la cola
+        # que cae dentro del margen de la marca nueva.
+        for fila in lote:
+            fecha = fila[_ACTUALIZADA]
+            self._recientes.append((fecha, fila[0]))
+            if self.marca is None or fecha > self.marca:
+                self.marca = fecha
+        while self._recientes and self._recientes[0][0] < self.marca - MARGEN:
+            self._recientes.popleft()
+
+
+def csv_de_lote(lote, encabezado=False):
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    if encabezado:
+        escritor.writerow(ENCABEZADOS)
+    escritor.writerows(lote)
+    return buffer.getvalue()
+
+
+def compresor_gzip():
+    # wbits=31 produce un flujo gzip valido para enviar por partes.
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+def csv_gzip(lotes):
+    """Partes de un CSV comprimido con gzip, generadas lote a lote."""
+    compresor = compresor_gzip()
+    yield compresor.compress(csv_de_lote([], encabezado=True).encode('utf-8'))
+    for lote in lotes:
+        parte = compresor.compress(csv_de_lote(lote).encode('utf-8'))
+        if parte:
+            yield parte
+    yield compresor.flush()
+
+
+# Escritores de archivo. Todos reciben lotes y solo mantienen uno en memoria.
+
+class EscritorCSV:
+    extension = '.csv.gz'
+
+    def __init__(self, ruta):
+        self.archivo = gzip.open(ruta, 'wt', newline='', encoding='utf-8')
+        self.archivo.write(csv_de_lote([], encabezado=True))
+
+    def escribir(self, lote):
+        self.archivo.write(csv_de_lote(lote))
+
+    def cerrar(self):
+        self.archivo.close()
+
+
+def _esquema_parquet():
+    texto = pyarrow.string()
+    fecha = pyarrow.timestamp('us', tz='UTC')
+    tipos = {
+        'id': pyarrow.int64(),
+        'fecha_hora': fecha,
+        'actualizada': fecha,
+        'paciente_id': pyarrow.int64(),
+        'paciente_fecha_nacimiento': pyarrow.date32(),
+        'medico_id': pyarrow.int64(),
+    }
+    return pyarrow.schema([(columna, tipos.get(columna, texto)) for columna in ENCABEZADOS])
+
+
+class EscritorParquet:
+    extension = '.parquet'
+
+    def __init__(self, ruta):
+        if pyarrow is None:
+            raise RuntimeError("La exportación a Parquet requiere instalar pyarrow.")
+        self.esquema = _esquema_parquet()
+        self.archivo = pyarrow.parquet.ParquetWriter(ruta, self.esquema, compression='zstd')
+
+    def escribir(self, lote):
+        # Cada lote se escribe como un row group independiente.
+        columnas = list(zip(*lote))
+        self.archivo.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(valores, type=campo.type) for valores, campo in zip(columnas, self.esquema)],
+            schema=self.esquema,
+        ))
+
+    def cerrar(self):
+        self.archivo.close()
+
+
+ESCRITORES = {
+    'csv': EscritorCSV,
+    'parquet': EscritorParquet,
+}
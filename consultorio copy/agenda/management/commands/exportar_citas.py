@@ -0,0 +1,74 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from agenda import exportacion
+
+
+class Command(BaseCommand):
+    help = "Exporta el historial de citas (con paciente y médico) a CSV comprimido o Parquet."
+
+    def add_arguments(self, parser):
+        parser.add_argument('salida', help="Ruta del archivo sin extensión, p. ej. exportes/citas")
+        parser.add_argument('--formato', choices=sorted(exportacion.ESCRITORES), default='csv')
+        parser.add_argument('--desde', help="Exportar solo citas modificadas después de esta fecha (ISO 8601).")
+        parser.add_argument(
+            '--incremental', action='store_true',
+            help="Exportar solo lo modificado desde la última ejecución (guardado en <salida>.marca).",
+        )
+        parser.add_argument('--lote', type=int, default=exportacion.TAMANO_LOTE)
+
+    def handle(self, *args, **options):
+        escritor_clase = exportacion.ESCRITORES[options['formato']]
+        base = Path(options['salida'])
+        ruta_marca = base.with_name(base.name + '.marca')
+
+        estado = exportacion.EstadoIncremental()
+        if options['desde']:
+            desde = exportacion.fecha_con_zona(parse_datetime(options['desde']))
+            if desde is None:
+                raise CommandError("Fecha inválida en --desde.")
+        elif options['incremental'] and ruta_marca.exists():
+            # Se relee el margen anterior a la marca y se omite lo ya exportado
+            estado = exportacion.EstadoIncremental.leer(ruta_marca)
+            desde = estado.desde
+        else:
+            desde = None
+
+        total = exportacion.contar(desde)
+        if total == 0:
+            self.stdout.write("No hay citas nuevas para exportar.")
+            return
+
+        # En modo incremental cada ejecucion genera un archivo propio.
+        nombre = base.name
+        if desde is not None:
+            nombre += '-desde-' + desde.strftime('%Y%m%dT%H%M%S')
+        ruta = base.with_name(nombre + escritor_clase.extension)
+
+        try:
+            escritor = escritor_clase(ruta)
+        except RuntimeError as e:
+            raise CommandError(str(e))
+
+        escritas = 0
+        try:
+            for lote in exportacion.iterar_lotes(desde, options['lote'], estado.vistas):
+                escritor.escribir(lote)
+                estado.registrar(lote)
+                escritas += len(lote)
+                self.stderr.write(f"\r{escritas}/{total} citas ({min(escritas * 100 // total, 100)}%)", ending='')
+        finally:
+            escritor.cerrar()
+        self.stderr.write('')
+
+        if escritas == 0:
+            ruta.unlink()
+            self.stdout.write("No hay citas nuevas para exportar.")
+            return
+
+        if options['incremental'] or options['desde']:
+            estado.guardar(ruta_marca)
+
+        self.stdout.write(self.style.SUCCESS(f"Se exportaron {escritas} citas a {ruta}"))
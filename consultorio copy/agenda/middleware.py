@@ -0,0 +1,24 @@
+from asgiref.sync import iscoroutinefunction
+from django.utils.decorators import sync_and_async_middleware
+
+from .auditoria import peticion_actual
+
+
+# Deja el usuario de la peticion disponible para la auditoria de las señales.
+@sync_and_async_middleware
+def AuditoriaMiddleware(get_response):
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            token = peticion_actual.set(request)
+            try:
+                return await get_response(request)
+            finally:
+                peticion_actual.reset(token)
+    else:
+        def middleware(request):
+            token = peticion_actual.set(request)
+            try:
+                return get_response(request)
+            finally:
+                peticion_actual.reset(token)
+    return middleware
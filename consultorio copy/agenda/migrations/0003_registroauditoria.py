@@ -0,0 +1,32 @@
+# Generated by Django 5.2.8 on 2026-10-19 10:55
+
+import django.core.serializers.json
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agenda', '0002_paciente_user_alter_paciente_fecha_nacimiento'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RegistroAuditoria',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('modelo', models.CharField(max_length=50)),
+                ('objeto_id', models.BigIntegerField()),
+                ('accion', models.CharField(choices=[('creacion', 'Creación'), ('modificacion', 'Modificación'), ('eliminacion', 'Eliminación')], max_length=12)),
+                ('cambios', models.JSONField(encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('fecha', models.DateTimeField()),
+                ('usuario', models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['modelo', 'objeto_id', 'fecha'], name='auditoria_objeto_idx'), models.Index(fields=['usuario', 'fecha'], name='auditoria_usuario_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.8 on 2026-10-19 10:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agenda', '0003_registroauditoria'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cita',
+            name='actualizada',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='cita',
+            index=models.Index(fields=['actualizada', 'id'], name='cita_actualizada_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.8 on 2026-10-19 10:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agenda', '0004_cita_actualizada'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cita',
+            index=models.Index(fields=['paciente', 'fecha_hora'], name='cita_paciente_fecha_idx'),
+        ),
+    ]
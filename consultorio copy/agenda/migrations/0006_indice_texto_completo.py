@@ -0,0 +1,62 @@
+# Indice de texto completo para Cita.motivo y Cita.notas_atencion (ver agenda/busqueda.py)
+
+from django.db import migrations
+
+
+def crear_indice(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE agenda_cita_fts USING fts5("
+            "motivo, notas_atencion, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        schema_editor.execute(
+            "INSERT INTO agenda_cita_fts (rowid, motivo, notas_atencion) "
+            "SELECT id, motivo, notas_atencion FROM agenda_cita"
+        )
+    elif connection.vendor == 'microsoft':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT FULLTEXTSERVICEPROPERTY('IsFullTextInstalled')")
+            if not cursor.fetchone()[0]:
+                # Sin el componente Full-Text Search la busqueda usa MotorSQLServer y fallara;
+                # se puede configurar AGENDA_BUSQUEDA_MOTOR = 'agenda.busqueda.MotorBasico'.
+                return
+            cursor.execute(
+                "SELECT name FROM sys.indexes "
+                "WHERE object_id = OBJECT_ID('agenda_cita') AND is_primary_key = 1"
+            )
+            clave = cursor.fetchone()[0]
+        schema_editor.execute("CREATE FULLTEXT CATALOG agenda_catalogo")
+        schema_editor.execute(
+            f"CREATE FULLTEXT INDEX ON agenda_cita (motivo, notas_atencion) "
+            f"KEY INDEX [{clave}] ON agenda_catalogo WITH CHANGE_TRACKING AUTO"
+        )
+
+
+def borrar_indice(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS agenda_cita_fts")
+    elif connection.vendor == 'microsoft':
+        schema_editor.execute(
+            "IF EXISTS (SELECT 1 FROM sys.fulltext_indexes WHERE object_id = OBJECT_ID('agenda_cita')) "
+            "DROP FULLTEXT INDEX ON agenda_cita"
+        )
+        schema_editor.execute(
+            "IF EXISTS (SELECT 1 FROM sys.fulltext_catalogs WHERE name = 'agenda_catalogo') "
+            "DROP FULLTEXT CATALOG agenda_catalogo"
+        )
+
+
+class Migration(migrations.Migration):
+
+    # CREATE FULLTEXT CATALOG/INDEX no se permiten dentro de una transaccion en SQL Server.
+    atomic = False
+
+    dependencies = [
+        ('agenda', '0005_cita_paciente_fecha_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(crear_indice, borrar_indice),
+    ]
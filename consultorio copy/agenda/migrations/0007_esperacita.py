@@ -0,0 +1,31 @@
+# Generated by Django 5.2.8 on 2026-10-19 10:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agenda', '0006_indice_texto_completo'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EsperaCita',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('especialidad', models.CharField(blank=True, max_length=50)),
+                ('motivo', models.TextField(blank=True)),
+                ('prioridad', models.PositiveSmallIntegerField(choices=[(0, 'Normal'), (1, 'Preferente'), (2, 'Urgente')], default=0)),
+                ('estado', models.CharField(choices=[('esperando', 'Esperando'), ('asignada', 'Asignada'), ('cancelada', 'Cancelada')], default='esperando', max_length=10)),
+                ('creada', models.DateTimeField(auto_now_add=True)),
+                ('cita', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='agenda.cita')),
+                ('medico', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='agenda.medico')),
+                ('paciente', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='agenda.paciente')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['estado', 'creada'], name='espera_estado_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.8 on 2026-10-19 11:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agenda', '0007_esperacita'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='esperacita',
+            name='espera_estado_idx',
+        ),
+        migrations.AddIndex(
+            model_name='esperacita',
+            index=models.Index(fields=['estado', 'medico', '-prioridad', 'creada'], name='espera_medico_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='esperacita',
+            index=models.Index(fields=['estado', 'especialidad', '-prioridad', 'creada'], name='espera_especialidad_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='cita',
+            constraint=models.UniqueConstraint(condition=models.Q(('estado', 'cancelada'), _negated=True), fields=('medico', 'fecha_hora'), name='cita_medico_horario_unico'),
+        ),
+    ]
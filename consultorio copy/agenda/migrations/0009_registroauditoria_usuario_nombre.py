@@ -0,0 +1,32 @@
+# Generated by Django 5.2.8 on 2026-10-19 11:20
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def copiar_nombres(apps, schema_editor):
+    # Los registros existentes toman el nombre del usuario que aun este vinculado
+    RegistroAuditoria = apps.get_model('agenda', 'RegistroAuditoria')
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    RegistroAuditoria.objects.filter(usuario__isnull=False).update(
+        usuario_nombre=models.Subquery(
+            User.objects.filter(pk=models.OuterRef('usuario_id')).values('username')[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('agenda', '0008_espera_indices_cita_horario_unico'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='registroauditoria',
+            name='usuario_nombre',
+            field=models.CharField(blank=True, max_length=150),
+        ),
+        migrations.RunPython(copiar_nombres, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.core.serializers.json import DjangoJSONEncoder
 
 #  Modelo Paciente
 class Paciente(models.Model):
@@ -33,6 +34,89 @@ class Cita(models.Model):
     ]
     estado = models.CharField(max_length=10, choices=ESTADOS, default='pendiente')
     notas_atencion = models.TextField(blank=True, null=True)
+    actualizada = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Recorrido por lotes de las exportaciones incrementales
+            models.Index(fields=['actualizada', 'id'], name='cita_actualizada_idx'),
+            # Linea de tiempo de cada paciente
+            models.Index(fields=['paciente', 'fecha_hora'], name='cita_paciente_fecha_idx'),
+        ]
+        constraints = [
+            # Un medico no puede tener dos citas vigentes a la misma hora
+            models.UniqueConstraint(
+                fields=['medico', 'fecha_hora'],
+                condition=~models.Q(estado='cancelada'),
+                name='cita_medico_horario_unico',
+            ),
+        ]
+
+    def __str__(self):
+        return f"Cita {self.id} - {self.paciente}"
+
+
+# Registro de auditoria: un cambio (con su diff antes/despues) sobre un registro clinico
+class RegistroAuditoria(models.Model):
+    ACCIONES = [
+        ('creacion', 'Creación'),
+        ('modificacion', 'Modificación'),
+        ('eliminacion', 'Eliminación'),
+    ]
+    modelo = models.CharField(max_length=50)
+    objeto_id = models.BigIntegerField()
+    accion = models.CharField(max_length=12, choices=ACCIONES)
+    usuario = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, db_index=False)
+    # Copia del nombre de usuario: identifica al autor aunque se borre el User
+    usuario_nombre = models.CharField(max_length=150, blank=True)
+    cambios = models.JSONField(encoder=DjangoJSONEncoder)
+    fecha = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['modelo', 'objeto_id', 'fecha'], name='auditoria_objeto_idx'),
+            models.Index(fields=['usuario', 'fecha'], name='auditoria_usuario_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_accion_display()} {self.modelo} {self.objeto_id}"
+
+
+# Modelo EsperaCita: paciente en lista de espera por un medico o una especialidad
+class EsperaCita(models.Model):
+    paciente = models.ForeignKey(Paciente, on_delete=models.CASCADE)
+    # Si no se indica medico, sirve cualquier medico de la especialidad
+    medico = models.ForeignKey(Medico, on_delete=models.CASCADE, null=True, blank=True)
+    especialidad = models.CharField(max_length=50, blank=True)
+    motivo = models.TextField(blank=True)
+
+    PRIORIDADES = [
+        (0, 'Normal'),
+        (1, 'Preferente'),
+        (2, 'Urgente'),
+    ]
+    prioridad = models.PositiveSmallIntegerField(choices=PRIORIDADES, default=0)
+
+    ESTADOS = [
+        ('esperando', 'Esperando'),
+        ('asignada', 'Asignada'),
+        ('cancelada', 'Cancelada'),
+    ]
+    estado = models.CharField(max_length=10, choices=ESTADOS, default='esperando')
+    creada = models.DateTimeField(auto_now_add=True)
+    cita = models.OneToOneField(Cita, on_delete=models.SET_NULL, null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Mejor candidato por medico y por especialidad (ver agenda/espera.py)
+            models.Index(fields=['estado', 'medico', '-prioridad', 'creada'], name='espera_medico_idx'),
+            models.Index(fields=['estado', 'especialidad', '-prioridad', 'creada'], name='espera_especialidad_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        # Normalizada para buscarla por igualdad (con indice) en la reasignacion
+        self.especialidad = (self.especialidad or '').strip().lower()
+        super().save(*args, **kwargs)
 
     def __str__(self):
-        return f"Cita {self.id} - {self.paciente}"
\ No newline at end of file
+        return f"Espera {self.id} - {self.paciente}"
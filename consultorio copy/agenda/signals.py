@@ -0,0 +1,54 @@
+from django.db import transaction
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from . import auditoria
+from .busqueda import obtener_motor
+from .models import Cita
+from .eventos import evento_cita, obtener_bus
+
+
+# Campos de Cita que se guardan en el diff de auditoria
+CAMPOS_AUDITADOS = ['paciente_id', 'medico_id', 'fecha_hora', 'motivo', 'estado', 'notas_atencion']
+
+
+def _publicar_al_confirmar(evento):
+    # Solo se avisa a los navegadores cuando el cambio ya es visible en la base.
+    transaction.on_commit(lambda: obtener_bus().publicar(evento))
+
+
+@receiver(post_init, sender=Cita)
+def cita_cargada(sender, instance, **kwargs):
+    # Solo se copian los valores; se normalizan al guardar, si hay diff que calcular.
+    instance._auditoria_original = auditoria.valores(instance, CAMPOS_AUDITADOS)
+
+
+@receiver(post_save, sender=Cita)
+def cita_guardada(sender, instance, created, **kwargs):
+    _publicar_al_confirmar(evento_cita(instance, 'creada' if created else 'actualizada'))
+
+    actual = auditoria.instantanea(instance, CAMPOS_AUDITADOS)
+    if created:
+        cambios = auditoria.diferencias({}, actual)
+        auditoria.registrar(instance, 'creacion', cambios)
+    else:
+        antes = auditoria.normalizados(instance, instance._auditoria_original)
+        cambios = auditoria.diferencias(antes, actual)
+        if cambios:
+            auditoria.registrar(instance, 'modificacion', cambios)
+    instance._auditoria_original = actual
+
+    # El indice de texto se actualiza en la misma transaccion que la cita.
+    if created or 'motivo' in cambios or 'notas_atencion' in cambios:
+        obtener_motor().indexar(instance)
+
+
+@receiver(post_delete, sender=Cita)
+def cita_eliminada(sender, instance, **kwargs):
+    _publicar_al_confirmar(evento_cita(instance, 'eliminada'))
+
+    antes = auditoria.instantanea(instance, CAMPOS_AUDITADOS)
+    auditoria.registrar(instance, 'eliminacion', auditoria.diferencias(antes, dict.fromkeys(antes)))
+
+    obtener_motor().eliminar(instance.id)
+
@@ -1,3 +1,722 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import io
+import json
+import tempfile
+import threading
+import time
+import warnings
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import auditoria, busqueda, exportacion
+from .eventos import Difusor, EVENTO_RESINCRONIZAR, difusor
+from .espera import MotorEspera, motor_espera
+from .models import Paciente, Medico, Cita, EsperaCita, RegistroAuditoria
+
+
+def _proxima_hora(dias=2, hora=10):
+    # Hora local exacta en el futuro, en el formato de los formularios
+    return (timezone.localtime() + timedelta(days=dias)).replace(hour=hora, minute=0, second=0, microsecond=0)
+
+
+class DifusorTests(TestCase):
+
+    async def test_difunde_a_todas_las_suscripciones(self):
+        d = Difusor()
+        primera, segunda = d.suscribir(), d.suscribir()
+
+        d.difundir({'id': 1})
+        await asyncio.sleep(0)
+
+        self.assertEqual(primera.cola.get_nowait(), {'id': 1})
+        self.assertEqual(segunda.cola.get_nowait(), {'id': 1})
+
+    async def test_filtro_por_suscripcion(self):
+        d = Difusor()
+        suscripcion = d.suscribir(lambda evento: evento['paciente_id'] == 7)
+
+        d.difundir({'paciente_id': 3})
+        d.difundir({'paciente_id': 7})
+        await asyncio.sleep(0)
+
+        self.assertEqual(suscripcion.cola.qsize(), 1)
+        self.assertEqual(suscripcion.cola.get_nowait(), {'paciente_id': 7})
+
+    async def test_cola_llena_pide_resincronizar(self):
+        d = Difusor()
+        lenta = d.suscribir()
+
+        for i in range(lenta.cola.maxsize + 1):
+            d.difundir({'id': i})
+        await asyncio.sleep(0)
+
+        self.assertEqual(lenta.cola.qsize(), 1)
+        self.assertEqual(lenta.cola.get_nowait(), EVENTO_RESINCRONIZAR)
+
+    async def test_desuscribir(self):
+        d = Difusor()
+        suscripcion = d.suscribir()
+        d.desuscribir(suscripcion)
+
+        d.difundir({'id': 1})
+        await asyncio.sleep(0)
+
+        self.assertEqual(d.cantidad(), 0)
+        self.assertTrue(suscripcion.cola.empty())
+
+
+@override_settings(AGENDA_AUDITORIA_SINCRONA=True)
+class EventosCitasTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='ana', password='x')
+        self.paciente = Paciente.objects.create(user=self.user, nombre='Ana', telefono='123')
+        self.otro = Paciente.objects.create(nombre='Beto', telefono='123')
+        self.medico = Medico.objects.create(nombre='Carla', especialidad='Cardiologia')
+
+    def crear_cita(self, paciente, hora):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Cita.objects.create(paciente=paciente, medico=self.medico, fecha_hora=_proxima_hora(hora=hora), motivo='x')
+
+    async def conectar(self):
+        client = AsyncClient()
+        await client.aforce_login(self.user)
+        response = await client.get(reverse('eventos_citas'))
+        flujo = response.streaming_content
+        self.assertEqual(await anext(flujo), b'retry: 5000\n\n')
+        return flujo
+
+    async def test_paciente_solo_recibe_sus_citas(self):
+        flujo = await self.conectar()
+
+        await sync_to_async(self.crear_cita)(self.otro, 9)
+        propia = await sync_to_async(self.crear_cita)(self.paciente, 10)
+
+        parte = await asyncio.wait_for(anext(flujo), 1)
+        evento = json.loads(parte.decode().split('data: ')[1])
+        self.assertEqual((evento['accion'], evento['id']), ('creada', propia.id))
+        await flujo.aclose()
+
+    async def test_desconexion_desuscribe(self):
+        flujo = await self.conectar()
+        self.assertEqual(difusor.cantidad(), 1)
+
+        # El cliente se va mientras la conexion espera eventos
+        espera = asyncio.ensure_future(anext(flujo))
+        await asyncio.sleep(0.05)
+        espera.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await espera
+
+        self.assertEqual(difusor.cantidad(), 0)
+
+    def test_sin_asgi_responde_sin_contenido(self):
+        self.client.force_login(self.user)
+
+        self.assertEqual(self.client.get(reverse('eventos_citas')).status_code, 204)
+        self.assertNotContains(self.client.get(reverse('inicio')), 'EventSource')
+
+
+@override_settings(AGENDA_AUDITORIA_SINCRONA=True)
+class AuditoriaMiddlewareTests(TestCase):
+
+    def test_vista_async_con_cliente_sincrono(self):
+        # El middleware no debe forzar la carga del usuario dentro del contexto async.
+        staff = User.objects.create_user(username='staff', password='x', is_staff=True)
+        self.client.force_login(staff)
+
+        response = self.client.get(reverse('exportar_citas'))
+
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(AGENDA_AUDITORIA_SINCRONA=True)
+class AuditoriaTests(TestCase):
+
+    def setUp(self):
+        self.staff = User.objects.create_user(username='staff', password='x', is_staff=True)
+        self.client.force_login(self.staff)
+        self.paciente = Paciente.objects.create(nombre='Ana', telefono='123')
+        self.medico = Medico.objects.create(nombre='Beto', especialidad='Cardiologia')
+        self.horario = _proxima_hora()
+
+    def datos_cita(self, horario=None, motivo='Control'):
+        return {
+            'cita-paciente-id': self.paciente.id,
+            'cita-medico-id': self.medico.id,
+            'cita-fecha': (horario or self.horario).strftime('%Y-%m-%dT%H:%M'),
+            'cita-motivo': motivo,
+        }
+
+    def agendar(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('agendar_cita'), self.datos_cita())
+        return Cita.objects.get()
+
+    def test_creacion_registra_valores_y_usuario(self):
+        cita = self.agendar()
+
+        registro = auditoria.historial(cita).get()
+        self.assertEqual(registro.accion, 'creacion')
+        self.assertEqual(registro.usuario, self.staff)
+        self.assertEqual(registro.cambios['motivo'], [None, 'Control'])
+        self.assertEqual(registro.cambios['paciente_id'], [None, self.paciente.id])
+        self.assertNotIn('notas_atencion', registro.cambios)
+
+    def test_modificacion_registra_solo_lo_que_cambio(self):
+        cita = self.agendar()
+
+        # Mismos datos (ids como texto, fecha sin zona): no es un cambio
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('editar_cita', args=[cita.id]), self.datos_cita())
+        self.assertEqual(auditoria.historial(cita).count(), 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('editar_cita', args=[cita.id]), self.datos_cita(motivo='Dolor de pecho'))
+
+        registro = auditoria.historial(cita).filter(accion='modificacion').get()
+        self.assertEqual(registro.cambios, {'motivo': ['Control', 'Dolor de pecho']})
+        self.assertEqual(registro.usuario, self.staff)
+
+    def test_eliminacion_registra_valores_anteriores(self):
+        cita = self.agendar()
+        cita_id = cita.id
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('eliminar_cita', args=[cita_id]))
+
+        registro = RegistroAuditoria.objects.get(objeto_id=cita_id, accion='eliminacion')
+        self.assertEqual(registro.cambios['motivo'], ['Control', None])
+        self.assertEqual(list(auditoria.acciones_de(self.staff).values_list('accion', flat=True)),
+                         ['eliminacion', 'creacion'])
+
+    def test_usuario_borrado_sigue_identificado(self):
+        cita = self.agendar()
+        self.staff.delete()
+
+        registro = auditoria.historial(cita).get()
+        self.assertIsNone(registro.usuario)
+        self.assertEqual(registro.usuario_nombre, 'staff')
+
+    def test_sin_peticion_no_hay_usuario(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            cita = Cita.objects.create(paciente=self.paciente, medico=self.medico, fecha_hora=self.horario, motivo='x')
+        registro = auditoria.historial(cita).get()
+        self.assertIsNone(registro.usuario)
+        self.assertEqual(registro.usuario_nombre, '')
+
+    def test_leer_citas_no_normaliza(self):
+        self.agendar()
+
+        # La normalizacion solo corre al calcular un diff, no en cada lectura
+        with mock.patch.object(auditoria, '_normalizar') as normalizar:
+            list(Cita.objects.all())
+        normalizar.assert_not_called()
+
+    def test_cambio_revertido_no_se_audita(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    Cita.objects.create(paciente=self.paciente, medico=self.medico, fecha_hora=self.horario, motivo='x')
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertFalse(RegistroAuditoria.objects.exists())
+
+    def test_hilo_guarda_en_lotes(self):
+        guardados = []
+        for i in range(5):
+            auditoria._cola.put(i)
+        auditoria._cola.put(auditoria._FIN)
+
+        with mock.patch.object(auditoria, 'TAMANO_LOTE', 2), \
+                mock.patch.object(auditoria, '_guardar', side_effect=lambda lote: guardados.append(list(lote))):
+            auditoria._trabajar()
+
+        self.assertEqual(guardados, [[0, 1], [2, 3], [4]])
+
+    def test_registro_invalido_no_bloquea_el_lote(self):
+        valido = RegistroAuditoria(modelo='agenda.cita', objeto_id=1, accion='creacion', cambios={},
+                                   fecha=timezone.now())
+        invalido = RegistroAuditoria(modelo='agenda.cita', objeto_id=2, accion='creacion', cambios=None,
+                                     fecha=timezone.now())
+        auditoria._cola.put(valido)
+        auditoria._cola.put(invalido)
+        auditoria._cola.put(auditoria._FIN)
+
+        with self.assertLogs('agenda.auditoria', 'ERROR'):
+            auditoria._trabajar()
+
+        self.assertEqual(list(RegistroAuditoria.objects.values_list('objeto_id', flat=True)), [1])
+
+
+class AuditoriaHiloTests(TransactionTestCase):
+
+    def setUp(self):
+        auditoria.vaciar()
+
+    def test_detener_guarda_lo_encolado(self):
+        paciente = Paciente.objects.create(nombre='Ana', telefono='123')
+        medico = Medico.objects.create(nombre='Beto', especialidad='Cardiologia')
+
+        # Commits reales: los registros pasan por la cola y el hilo en segundo plano
+        for hora in range(8, 11):
+            Cita.objects.create(paciente=paciente, medico=medico, fecha_hora=_proxima_hora(hora=hora), motivo='x')
+        auditoria.detener()
+
+        self.assertEqual(RegistroAuditoria.objects.filter(accion='creacion').count(), 3)
+        self.assertTrue(auditoria._cola.empty())
+
+    def test_usuario_borrado_antes_de_guardar(self):
+        otro = User.objects.create_user(username='temporal', password='x')
+        registro = RegistroAuditoria(modelo='agenda.cita', objeto_id=1, accion='creacion', usuario_id=otro.id,
+                                     usuario_nombre='temporal', cambios={}, fecha=timezone.now())
+        otro.delete()
+
+        auditoria._guardar_de_a_uno([registro])
+
+        guardado = RegistroAuditoria.objects.get()
+        self.assertIsNone(guardado.usuario_id)
+        self.assertEqual(guardado.usuario_nombre, 'temporal')
+
+
+class ExportacionTests(TestCase):
+
+    def setUp(self):
+        self.paciente = Paciente.objects.create(nombre='Ana, "la" primera', telefono='123')
+        self.medico = Medico.objects.create(nombre='Beto', especialidad='Cardiologia')
+        self.citas = [
+            Cita.objects.create(paciente=self.paciente, medico=self.medico, fecha_hora=_proxima_hora(hora=8 + i), motivo=f'm{i}')
+            for i in range(7)
+        ]
+        self.directorio = tempfile.TemporaryDirectory()
+        self.salida = Path(self.directorio.name) / 'citas'
+
+    def tearDown(self):
+        self.directorio.cleanup()
+
+    def exportar(self, *args):
+        call_command('exportar_citas', str(self.salida), *args, stdout=io.StringIO(), stderr=io.StringIO())
+
+    def ids_en(self, ruta):
+        with gzip.open(ruta, 'rt', newline='') as archivo:
+            return [int(linea.split(',')[0]) for linea in list(archivo)[1:]]
+
+    def test_cursor_recorre_lotes_con_la_misma_marca(self):
+        Cita.objects.update(actualizada=timezone.now())
+
+        lotes = list(exportacion.iterar_lotes(tamano=3))
+
+        self.assertEqual([len(lote) for lote in lotes], [3, 3, 1])
+        self.assertEqual([fila[0] for lote in lotes for fila in lote], [cita.id for cita in self.citas])
+
+    def test_csv_completo_con_paciente_y_medico(self):
+        self.exportar('--lote', '2')
+
+        with gzip.open(Path(str(self.salida) + '.csv.gz'), 'rt', newline='') as archivo:
+            filas = list(csv.DictReader(archivo))
+        self.assertEqual(len(filas), 7)
+        self.assertEqual(filas[0]['paciente_nombre'], 'Ana, "la" primera')
+        self.assertEqual(filas[0]['medico_especialidad'], 'Cardiologia')
+
+    def test_incremental_incluye_commits_tardios_sin_duplicar(self):
+        self.exportar('--incremental', '--lote', '3')
+        estado = exportacion.EstadoIncremental.leer(Path(str(self.salida) + '.marca'))
+
+        # Guardada antes de la marca pero confirmada despues de la exportacion
+        tardia = Cita.objects.create(paciente=self.paciente, medico=self.medico, fecha_hora=_proxima_hora(hora=18), motivo='t')
+        Cita.objects.filter(id=tardia.id).update(actualizada=estado.marca - timedelta(seconds=1))
+        modificada = self.citas[0]
+        modificada.motivo = 'cambio'
+        modificada.save()
+
+        self.exportar('--incremental', '--lote', '3')
+
+        segunda = Path(self.directorio.name) / ('citas-desde-' + estado.desde.strftime('%Y%m%dT%H%M%S') + '.csv.gz')
+        self.assertEqual(sorted(self.ids_en(segunda)), sorted([tardia.id, modificada.id]))
+
+    def test_incremental_sin_cambios_no_genera_archivo(self):
+        self.exportar('--incremental')
+        self.exportar('--incremental')
+
+        self.assertEqual(len(list(Path(self.directorio.name).glob('citas-desde-*'))), 0)
+
+    def test_desde_sin_zona_horaria(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            self.exportar('--desde', '2000-01-01T00:00:00')
+
+        self.assertEqual(len(self.ids_en(Path(self.directorio.name) / 'citas-desde-20000101T000000.csv.gz')), 7)
+
+    @skipUnless(exportacion.pyarrow, "pyarrow no está instalado")
+    def test_parquet_un_grupo_por_lote(self):
+        self.exportar('--formato', 'parquet', '--lote', '3')
+
+        archivo = exportacion.pyarrow.parquet.ParquetFile(Path(str(self.salida) + '.parquet'))
+        self.assertEqual(archivo.metadata.num_rows, 7)
+        self.assertEqual(archivo.metadata.num_row_groups, 3)
+        self.assertEqual(archivo.schema_arrow.names, exportacion.ENCABEZADOS)
+        self.assertEqual(archivo.read().column('motivo').to_pylist()[0], 'm0')
+
+    def test_endpoint_wsgi_usa_generador_sincrono(self):
+        staff = User.objects.create_user(username='staff', password='x', is_staff=True)
+        self.client.force_login(staff)
+
+        with warnings.catch_warnings():
+            # Django avisa cuando tiene que juntar un iterador async en memoria
+            warnings.simplefilter('error')
+            response = self.client.get(reverse('exportar_citas'))
+            contenido = b''.join(response.streaming_content)
+
+        lineas = gzip.decompress(contenido).decode().splitlines()
+        self.assertEqual(len(lineas), 8)
+
+    def test_endpoint_solo_staff(self):
+        self.client.force_login(User.objects.create_user(username='ana', password='x'))
+        self.assertEqual(self.client.get(reverse('exportar_citas')).status_code, 403)
+
+
+class BusquedaTests(TestCase):
+
+    def setUp(self):
+        self.ana = Paciente.objects.create(nombre='Ana', telefono='123')
+        self.beto = Paciente.objects.create(nombre='Beto', telefono='123')
+        self.medico = Medico.objects.create(nombre='Carla', especialidad='Cardiologia')
+
+    def cita(self, paciente, motivo, notas=None, dias=2, hora=10):
+        return Cita.objects.create(paciente=paciente, medico=self.medico, fecha_hora=_proxima_hora(dias=dias, hora=hora),
+                                   motivo=motivo, notas_atencion=notas)
+
+    def ids(self, consulta, **filtros):
+        return [cita.id for cita in busqueda.buscar_citas(consulta, **filtros)]
+
+    def test_motor_de_sqlite(self):
+        self.assertIsInstance(busqueda.obtener_motor(), busqueda.MotorFTS5)
+
+    def test_indice_sigue_altas_cambios_y_bajas(self):
+        cita = self.cita(self.ana, 'Control anual')
+        self.assertEqual(self.ids('control'), [cita.id])
+
+        cita.notas_atencion = 'Refiere dolor toracico'
+        cita.save()
+        self.assertEqual(self.ids('toracico'), [cita.id])
+
+        cita.motivo = 'Revision'
+        cita.save()
+        self.assertEqual(self.ids('control'), [])
+        self.assertEqual(self.ids('revision'), [cita.id])
+
+        cita.delete()
+        self.assertEqual(self.ids('revision'), [])
+
+    def test_resultados_ordenados_por_relevancia(self):
+        leve = self.cita(self.beto, 'Control general de rutina', 'menciona dolor leve de rodilla al caminar por la tarde')
+        fuerte = self.cita(self.ana, 'Dolor de pecho', 'dolor opresivo', hora=11)
+
+        self.assertEqual(self.ids('dolor'), [fuerte.id, leve.id])
+
+    def test_prefijos_y_acentos(self):
+        cita = self.cita(self.ana, 'Dolores en el pecho')
+        self.assertEqual(self.ids('dolor pécho'), [cita.id])
+
+    def test_consulta_no_inyecta_sintaxis(self):
+        self.cita(self.ana, 'Dolor de pecho')
+
+        for consulta in ['"; DROP TABLE agenda_cita; --', 'dolor OR', 'NEAR(dolor', 'pecho*"', '***', '']:
+            self.assertIsInstance(self.ids(consulta), list)
+        self.assertEqual(self.ids('dolor OR'), [])
+        self.assertTrue(Cita.objects.exists())
+
+    def test_filtros_de_paciente_y_fechas(self):
+        propia = self.cita(self.ana, 'Dolor de pecho', dias=2)
+        self.cita(self.beto, 'Dolor de pecho', dias=2, hora=11)
+        lejana = self.cita(self.ana, 'Dolor de pecho', dias=40)
+
+        self.assertEqual(sorted(self.ids('pecho', paciente_id=self.ana.id)), sorted([propia.id, lejana.id]))
+        self.assertEqual(self.ids('pecho', paciente_id=self.ana.id, desde=timezone.now() + timedelta(days=30)),
+                         [lejana.id])
+
+    def test_sqlserver_sin_indice_usa_motor_basico(self):
+        with mock.patch.object(busqueda, '_motor', None), \
+                mock.patch.dict(busqueda.MOTORES, {'sqlite': busqueda.MotorSQLServer}), \
+                mock.patch.object(busqueda.MotorSQLServer, 'disponible', return_value=False):
+            self.assertIsInstance(busqueda.obtener_motor(), busqueda.MotorBasico)
+
+
+class HistorialPacienteTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='ana', password='x')
+        self.ana = Paciente.objects.create(user=self.user, nombre='Ana', telefono='123')
+        self.beto = Paciente.objects.create(nombre='Beto', telefono='123')
+        self.medico = Medico.objects.create(nombre='Carla', especialidad='Cardiologia')
+        for dias in range(1, 26):
+            Cita.objects.create(paciente=self.ana, medico=self.medico, fecha_hora=_proxima_hora(dias=dias),
+                                motivo='Dolor de pecho' if dias == 3 else 'Control')
+
+    def test_paciente_ve_su_historial_paginado(self):
+        self.client.force_login(self.user)
+
+        response = self.client.get(reverse('historial_paciente', args=[self.ana.id]))
+        pagina = response.context['pagina']
+        self.assertEqual(len(pagina), 20)
+        self.assertEqual(pagina.paginator.count, 25)
+        fechas = [cita.fecha_hora for cita in pagina]
+        self.assertEqual(fechas, sorted(fechas, reverse=True))
+
+        self.assertEqual(len(self.client.get(reverse('historial_paciente', args=[self.ana.id]), {'pagina': 2}).context['pagina']), 5)
+
+    def test_paciente_no_ve_historial_ajeno(self):
+        self.client.force_login(self.user)
+
+        response = self.client.get(reverse('historial_paciente', args=[self.beto.id]))
+
+        self.assertRedirects(response, reverse('inicio'), fetch_redirect_response=False)
+
+    def test_staff_busca_en_el_historial(self):
+        self.client.force_login(User.objects.create_user(username='staff', password='x', is_staff=True))
+
+        response = self.client.get(reverse('historial_paciente', args=[self.ana.id]), {'q': 'pecho'})
+
+        self.assertEqual([cita.motivo for cita in response.context['pagina']], ['Dolor de pecho'])
+
+    def test_busqueda_general_solo_staff(self):
+        self.client.force_login(self.user)
+        self.assertRedirects(self.client.get(reverse('buscar_citas'), {'q': 'pecho'}), reverse('inicio'),
+                             fetch_redirect_response=False)
+
+
+@override_settings(AGENDA_AUDITORIA_SINCRONA=True)
+class ListaEsperaTests(TestCase):
+
+    def setUp(self):
+        self.cardio = Medico.objects.create(nombre='Ana', especialidad='Cardiologia')
+        self.cardio2 = Medico.objects.create(nombre='Beto', especialidad='Cardiologia')
+        self.derma = Medico.objects.create(nombre='Carla', especialidad='Dermatologia')
+        self.horario = (timezone.now() + timedelta(days=2)).replace(hour=10, minute=0, second=0, microsecond=0)
+
+    def paciente(self, nombre):
+        return Paciente.objects.create(nombre=nombre, telefono='123')
+
+    def esperar(self, paciente, medico=None, especialidad='', prioridad=0, minutos=0):
+        entrada = EsperaCita.objects.create(
+            paciente=paciente, medico=medico, especialidad=especialidad, prioridad=prioridad,
+        )
+        # Orden de llegada controlado
+        EsperaCita.objects.filter(id=entrada.id).update(creada=timezone.now() + timedelta(minutes=minutos))
+        return entrada
+
+    def liberar(self, medico, horas=0, excluir_paciente=None):
+        return motor_espera.liberar(medico, self.horario + timedelta(hours=horas), excluir_paciente)
+
+    def test_asigna_por_orden_de_llegada(self):
+        primero = self.paciente('Primero')
+        segundo = self.paciente('Segundo')
+        self.esperar(segundo, self.cardio, minutos=2)
+        self.esperar(primero, self.cardio, minutos=1)
+
+        self.assertEqual(self.liberar(self.cardio).paciente, primero)
+        self.assertEqual(self.liberar(self.cardio, horas=1).paciente, segundo)
+        self.assertIsNone(self.liberar(self.cardio, horas=2))
+
+    def test_prioridad_antes_que_llegada(self):
+        normal = self.paciente('Normal')
+        urgente = self.paciente('Urgente')
+        self.esperar(normal, self.cardio, minutos=1)
+        self.esperar(urgente, self.cardio, prioridad=2, minutos=5)
+
+        self.assertEqual(self.liberar(self.cardio).paciente, urgente)
+
+    def test_medico_y_especialidad_compiten_por_llegada(self):
+        por_especialidad = self.paciente('Especialidad')
+        por_medico = self.paciente('Medico')
+        self.esperar(por_medico, self.cardio, minutos=2)
+        self.esperar(por_especialidad, especialidad='cardiologia ', minutos=1)
+
+        # Cualquier cardiologo le sirve a quien espera por especialidad
+        self.assertEqual(self.liberar(self.cardio2).paciente, por_especialidad)
+        self.assertEqual(self.liberar(self.cardio).paciente, por_medico)
+
+    def test_no_asigna_otra_especialidad_ni_otro_medico(self):
+        self.esperar(self.paciente('A'), self.cardio)
+        self.esperar(self.paciente('B'), especialidad='Cardiologia')
+
+        self.assertIsNone(self.liberar(self.derma))
+
+    def test_no_devuelve_el_horario_al_mismo_paciente(self):
+        mismo = self.paciente('Mismo')
+        otro = self.paciente('Otro')
+        self.esperar(mismo, self.cardio, minutos=1)
+        self.esperar(otro, self.cardio, minutos=2)
+
+        self.assertEqual(self.liberar(self.cardio, excluir_paciente=mismo.id).paciente, otro)
+        # El paciente excluido sigue esperando
+        self.assertEqual(self.liberar(self.cardio, horas=1).paciente, mismo)
+
+    def test_no_agenda_dos_citas_a_la_misma_hora(self):
+        doble = self.paciente('Doble')
+        otro = self.paciente('Otro')
+        self.esperar(doble, self.cardio, minutos=1)
+        self.esperar(doble, self.derma, minutos=1)
+        self.esperar(otro, self.derma, minutos=2)
+
+        self.assertEqual(self.liberar(self.cardio).paciente, doble)
+        # A la misma hora el paciente ya esta ocupado: pasa el siguiente
+        self.assertEqual(self.liberar(self.derma).paciente, otro)
+        # Una hora despues si puede tomar el horario de dermatologia
+        self.assertEqual(self.liberar(self.derma, horas=1).paciente, doble)
+
+    def test_horario_pasado_no_se_reasigna(self):
+        self.esperar(self.paciente('A'), self.cardio)
+        self.assertIsNone(motor_espera.liberar(self.cardio, timezone.now() - timedelta(hours=1)))
+
+    def test_un_horario_una_cita_vigente(self):
+        Cita.objects.create(paciente=self.paciente('A'), medico=self.cardio, fecha_hora=self.horario, motivo='x', estado='cancelada')
+        Cita.objects.create(paciente=self.paciente('B'), medico=self.cardio, fecha_hora=self.horario, motivo='x')
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Cita.objects.create(paciente=self.paciente('C'), medico=self.cardio, fecha_hora=self.horario, motivo='x')
+
+    def test_horario_ocupado_antes_de_reasignar(self):
+        entrada = self.esperar(self.paciente('A'), self.cardio)
+        Cita.objects.create(paciente=self.paciente('B'), medico=self.cardio, fecha_hora=self.horario, motivo='x')
+
+        self.assertIsNone(self.liberar(self.cardio))
+        entrada.refresh_from_db()
+        self.assertEqual(entrada.estado, 'esperando')
+
+    def test_entrada_cancelada_no_se_asigna(self):
+        cancelada = self.esperar(self.paciente('A'), self.cardio, minutos=1)
+        sigue = self.paciente('B')
+        self.esperar(sigue, self.cardio, minutos=2)
+
+        cancelada.estado = 'cancelada'
+        cancelada.save()
+
+        self.assertEqual(motor_espera.liberar(self.cardio, self.horario).paciente, sigue)
+
+    def test_horario_con_cita_cancelada_se_puede_agendar(self):
+        self.client.force_login(User.objects.create_user(username='staff', password='x', is_staff=True))
+        horario = _proxima_hora()
+        Cita.objects.create(paciente=self.paciente('A'), medico=self.cardio, fecha_hora=horario, motivo='x', estado='cancelada')
+        otra = Cita.objects.create(paciente=self.paciente('C'), medico=self.cardio, fecha_hora=horario + timedelta(hours=1), motivo='x')
+        datos = {
+            'cita-paciente-id': self.paciente('B').id,
+            'cita-medico-id': self.cardio.id,
+            'cita-fecha': horario.strftime('%Y-%m-%dT%H:%M'),
+            'cita-motivo': 'Control',
+        }
+
+        self.client.post(reverse('agendar_cita'), datos)
+        self.assertEqual(Cita.objects.filter(fecha_hora=horario).exclude(estado='cancelada').count(), 1)
+
+        Cita.objects.filter(fecha_hora=horario).exclude(estado='cancelada').update(estado='cancelada')
+        datos['cita-paciente-id'] = otra.paciente_id
+        self.client.post(reverse('editar_cita', args=[otra.id]), datos)
+        otra.refresh_from_db()
+        self.assertEqual(otra.fecha_hora, horario)
+
+    def test_eliminar_cita_reasigna_el_horario(self):
+        staff = User.objects.create_user(username='staff', password='x', is_staff=True)
+        self.client.force_login(staff)
+        en_espera = self.paciente('Espera')
+        self.esperar(en_espera, self.cardio)
+        cita = Cita.objects.create(paciente=self.paciente('Dueño'), medico=self.cardio, fecha_hora=self.horario, motivo='x')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.get(reverse('eliminar_cita', args=[cita.id]))
+
+        nueva = Cita.objects.get(medico=self.cardio, fecha_hora=self.horario)
+        self.assertEqual(nueva.paciente, en_espera)
+        self.assertEqual(EsperaCita.objects.get(paciente=en_espera).cita, nueva)
+
+
+@override_settings(AGENDA_AUDITORIA_SINCRONA=True)
+class ListaEsperaConcurrenciaTests(TransactionTestCase):
+    # Cada hilo usa su propia conexion y su propio motor, como dos procesos.
+
+    def setUp(self):
+        self.medico = Medico.objects.create(nombre='Ana', especialidad='Cardiologia')
+        self.horario = (timezone.now() + timedelta(days=2)).replace(hour=10, minute=0, second=0, microsecond=0)
+
+    def esperar(self, nombre):
+        paciente = Paciente.objects.create(nombre=nombre, telefono='123')
+        return EsperaCita.objects.create(paciente=paciente, medico=self.medico)
+
+    def en_paralelo(self, *funciones):
+        barrera = threading.Barrier(len(funciones))
+        errores = []
+
+        def correr(funcion):
+            try:
+                barrera.wait()
+                for _ in range(100):
+                    try:
+                        return funcion()
+                    except OperationalError:
+                        # SQLite bloquea la base entera mientras otro hilo escribe
+                        time.sleep(0.01)
+                errores.append('La base siguio bloqueada')
+            except Exception as e:
+                errores.append(e)
+            finally:
+                connection.close()
+
+        hilos = [threading.Thread(target=correr, args=(funcion,)) for funcion in funciones]
+        for hilo in hilos:
+            hilo.start()
+        for hilo in hilos:
+            hilo.join()
+        self.assertEqual(errores, [])
+
+    def test_mismo_horario_se_asigna_una_vez(self):
+        self.esperar('A')
+        self.esperar('B')
+
+        self.en_paralelo(
+            lambda: MotorEspera().liberar(self.medico, self.horario),
+            lambda: MotorEspera().liberar(self.medico, self.horario),
+        )
+
+        self.assertEqual(Cita.objects.filter(medico=self.medico, fecha_hora=self.horario).count(), 1)
+        self.assertEqual(EsperaCita.objects.filter(estado='asignada').count(), 1)
+
+    def test_una_entrada_se_asigna_una_vez(self):
+        entrada = self.esperar('A')
+
+        self.en_paralelo(
+            lambda: MotorEspera().liberar(self.medico, self.horario),
+            lambda: MotorEspera().liberar(self.medico, self.horario + timedelta(hours=1)),
+        )
+
+        self.assertEqual(Cita.objects.filter(paciente=entrada.paciente).count(), 1)
+        entrada.refresh_from_db()
+        self.assertEqual(entrada.estado, 'asignada')
+        self.assertEqual(entrada.cita.paciente, entrada.paciente)
+
+    def test_reserva_y_reasignacion_del_mismo_horario(self):
+        self.esperar('A')
+        otro = Paciente.objects.create(nombre='Otro', telefono='123')
+
+        def reservar():
+            try:
+                with transaction.atomic():
+                    Cita.objects.create(paciente=otro, medico=self.medico, fecha_hora=self.horario, motivo='x')
+            except IntegrityError:
+                pass
+
+        self.en_paralelo(reservar, lambda: MotorEspera().liberar(self.medico, self.horario))
+
+        self.assertEqual(Cita.objects.filter(medico=self.medico, fecha_hora=self.horario).count(), 1)
@@ -1,6 +1,6 @@
 from django.urls import path
 from . import views
-from .views import index, registrar_paciente, registrar_medico, agendar_cita, eliminar_cita, editar_cita, generar_usuarios_aleatorios
+from .views import index, registrar_paciente, registrar_medico, agendar_cita, eliminar_cita, editar_cita, generar_usuarios_aleatorios, eventos_citas, exportar_citas, historial_paciente, buscar_citas, unirse_lista_espera
 
 urlpatterns = [
     path('', index, name='inicio'),
@@ -10,4 +10,9 @@ urlpatterns = [
     path('eliminar/cita/<int:id>/', eliminar_cita, name='eliminar_cita'),
     path('editar/cita/<int:id>/', editar_cita, name='editar_cita'),
     path('usuarios/generar/', generar_usuarios_aleatorios, name='generar_usuarios'),
+    path('espera/unirse/', unirse_lista_espera, name='unirse_lista_espera'),
+    path('pacientes/<int:id>/historial/', historial_paciente, name='historial_paciente'),
+    path('buscar/citas/', buscar_citas, name='buscar_citas'),
+    path('eventos/citas/', eventos_citas, name='eventos_citas'),
+    path('exportar/citas/', exportar_citas, name='exportar_citas'),
 ]
\ No newline at end of file
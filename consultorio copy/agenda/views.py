@@ -1,9 +1,20 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseForbidden, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
 from datetime import datetime, time, timedelta
-from .models import Paciente, Medico, Cita
+from .models import Paciente, Medico, Cita, EsperaCita
+from .eventos import difusor, INTERVALO_LATIDO
+from . import exportacion
+from .busqueda import buscar_citas as buscar_en_notas
+from django.core.paginator import Paginator
+from django.utils import timezone
+from django.db import IntegrityError, transaction
+from .espera import motor_espera
+from asgiref.sync import sync_to_async
+from django.utils.dateparse import parse_datetime
+import asyncio
 from django.contrib.auth.models import User
 import re
 import json
@@ -32,11 +43,15 @@ def index(request):
 
     lista_pacientes = Paciente.objects.all().order_by('nombre')
     lista_medicos = Medico.objects.all().order_by('nombre')
+    lista_especialidades = Medico.objects.values_list('especialidad', flat=True).distinct().order_by('especialidad')
 
     contexto = {
         'citas': lista_citas,
         'pacientes': lista_pacientes,
-        'medicos': lista_medicos
+        'medicos': lista_medicos,
+        'especialidades': lista_especialidades,
+        # Los avisos en vivo solo funcionan servidos por ASGI (ver eventos_citas)
+        'eventos_en_vivo': isinstance(request, ASGIRequest),
     }
     return render(request, 'agenda.html', contexto)
 
@@ -171,7 +186,7 @@ def agendar_cita(request):
             return redirect("inicio")
 
         
-        if Cita.objects.filter(medico_id=medico_id, fecha_hora=fecha_hora_obj).exists():
+        if Cita.objects.filter(medico_id=medico_id, fecha_hora=fecha_hora_obj).exclude(estado='cancelada').exists():
             messages.error(request, "Lo sentimos, el médico ya tiene una cita ocupada a esa hora exacta.")
             return redirect("inicio")
 
@@ -187,7 +202,10 @@ def agendar_cita(request):
                 motivo=motivo
             )
             messages.success(request, "Cita agendada correctamente.")
-            
+
+        except IntegrityError:
+            # Otra peticion tomo el horario despues de la verificacion de arriba
+            messages.error(request, "Lo sentimos, el médico ya tiene una cita ocupada a esa hora exacta.")
         except Exception as e:
             messages.error(request, f"Error al guardar la cita: {e}")
 
@@ -198,9 +216,14 @@ def agendar_cita(request):
 
 def eliminar_cita(request, id):
     try:
-        cita = Cita.objects.get(id=id)
-        cita.delete()
+        with transaction.atomic():
+            cita = Cita.objects.select_related('medico').get(id=id)
+            cita.delete()
+            # El horario liberado pasa al siguiente paciente en lista de espera
+            reasignada = motor_espera.liberar(cita.medico, cita.fecha_hora, excluir_paciente=cita.paciente_id)
         messages.success(request, "Cita eliminada correctamente.")
+        if reasignada:
+            messages.success(request, f"El horario se asignó a {reasignada.paciente} desde la lista de espera.")
     except Cita.DoesNotExist:
         messages.error(request, "La cita que intentas eliminar no existe.")
     
@@ -250,22 +273,36 @@ def editar_cita(request, id):
                 return redirect('editar_cita', id=id)
 
            
-            choque = Cita.objects.filter(medico_id=medico_id, fecha_hora=fecha_hora_obj).exclude(id=id).exists()
+            choque = Cita.objects.filter(medico_id=medico_id, fecha_hora=fecha_hora_obj).exclude(id=id).exclude(estado='cancelada').exists()
             
             if choque:
                 messages.error(request, "El médico ya tiene otra cita agendada a esa hora.")
                 return redirect('editar_cita', id=id)
 
           
-            cita.paciente_id = paciente_id
-            cita.medico_id = medico_id
-            cita.fecha_hora = fecha_hora_obj 
-            cita.motivo = motivo
-            cita.save()
+            medico_anterior = cita.medico
+            fecha_anterior = cita.fecha_hora
+            reasignada = None
+
+            with transaction.atomic():
+                cita.paciente_id = paciente_id
+                cita.medico_id = medico_id
+                cita.fecha_hora = fecha_hora_obj 
+                cita.motivo = motivo
+                cita.save()
+
+                # Si la cita se movio, el horario anterior queda libre
+                if str(medico_anterior.id) != str(medico_id) or timezone.make_naive(fecha_anterior) != fecha_hora_obj:
+                    reasignada = motor_espera.liberar(medico_anterior, fecha_anterior, excluir_paciente=cita.paciente_id)
             
             messages.success(request, "Cita actualizada correctamente.")
+            if reasignada:
+                messages.success(request, f"El horario anterior se asignó a {reasignada.paciente} desde la lista de espera.")
             return redirect('inicio')
 
+        except IntegrityError:
+            messages.error(request, "El médico ya tiene otra cita agendada a esa hora.")
+            return redirect('editar_cita', id=id)
         except Exception as e:
              messages.error(request, f"Error al editar: {e}")
              return redirect('editar_cita', id=id)
@@ -286,6 +323,197 @@ def editar_cita(request, id):
     return render(request, 'editar_cita.html', contexto)
 
 
+@login_required
+def unirse_lista_espera(request):
+    if request.method == 'POST':
+        medico_id = request.POST.get('espera-medico-id')
+        especialidad = request.POST.get('espera-especialidad', '').strip()
+        motivo = request.POST.get('espera-motivo', '')
+
+        if request.user.is_staff:
+            paciente_id = request.POST.get('espera-paciente-id')
+            prioridad = request.POST.get('espera-prioridad') or 0
+        else:
+            try:
+                paciente_id = request.user.paciente.id
+            except AttributeError:
+                messages.error(request, "Tu usuario no tiene un perfil de paciente asociado.")
+                return redirect('inicio')
+            prioridad = 0
+
+        if not medico_id and not especialidad:
+            messages.error(request, "Debes elegir un médico o una especialidad.")
+            return redirect('inicio')
+
+        if medico_id:
+            filtro_medico = {'medico_id': medico_id}
+        else:
+            filtro_medico = {'medico__isnull': True, 'especialidad__iexact': especialidad}
+        if EsperaCita.objects.filter(paciente_id=paciente_id, estado='esperando', **filtro_medico).exists():
+            messages.error(request, "El paciente ya está en esa lista de espera.")
+            return redirect('inicio')
+
+        try:
+            paciente_obj = get_object_or_404(Paciente, id=paciente_id)
+            medico_obj = get_object_or_404(Medico, id=medico_id) if medico_id else None
+
+            EsperaCita.objects.create(
+                paciente=paciente_obj,
+                medico=medico_obj,
+                especialidad=medico_obj.especialidad if medico_obj else especialidad,
+                motivo=motivo,
+                prioridad=int(prioridad),
+            )
+            messages.success(request, "Agregado a la lista de espera. Se asignará el primer horario que se libere.")
+        except Exception as e:
+            messages.error(request, f"Error al agregar a la lista de espera: {e}")
+
+    return redirect('inicio')
+
+
+def _rango_fechas(request):
+    # Filtros ?desde=AAAA-MM-DD&hasta=AAAA-MM-DD (hasta incluye el dia completo).
+    desde = hasta = None
+    try:
+        if request.GET.get('desde'):
+            desde = timezone.make_aware(datetime.strptime(request.GET['desde'], '%Y-%m-%d'))
+        if request.GET.get('hasta'):
+            hasta = timezone.make_aware(datetime.strptime(request.GET['hasta'], '%Y-%m-%d')) + timedelta(days=1)
+    except ValueError:
+        messages.error(request, "Formato de fecha inválido.")
+    return desde, hasta
+
+
+@login_required
+def historial_paciente(request, id):
+    paciente = get_object_or_404(Paciente, id=id)
+
+    if not request.user.is_staff and paciente.user_id != request.user.id:
+        messages.error(request, "No tienes permisos para ver este historial.")
+        return redirect('inicio')
+
+    consulta = request.GET.get('q', '').strip()
+    desde, hasta = _rango_fechas(request)
+
+    if consulta:
+        # Resultados ordenados por relevancia desde el indice de texto completo
+        citas = buscar_en_notas(consulta, paciente_id=paciente.id, desde=desde, hasta=hasta)
+    else:
+        # Recorre cita_paciente_fecha_idx: solo lee las citas de la pagina pedida
+        citas = Cita.objects.filter(paciente=paciente).select_related('medico').order_by('-fecha_hora')
+        if desde:
+            citas = citas.filter(fecha_hora__gte=desde)
+        if hasta:
+            citas = citas.filter(fecha_hora__lt=hasta)
+
+    pagina = Paginator(citas, 20).get_page(request.GET.get('pagina'))
+
+    contexto = {
+        'paciente': paciente,
+        'pagina': pagina,
+        'consulta': consulta,
+    }
+    return render(request, 'historial.html', contexto)
+
+
+@login_required
+def buscar_citas(request):
+    if not request.user.is_staff:
+        messages.error(request, "No tienes permisos para realizar esta acción.")
+        return redirect('inicio')
+
+    consulta = request.GET.get('q', '').strip()
+    desde, hasta = _rango_fechas(request)
+    citas = buscar_en_notas(consulta, desde=desde, hasta=hasta) if consulta else []
+
+    pagina = Paginator(citas, 20).get_page(request.GET.get('pagina'))
+
+    contexto = {
+        'paciente': None,
+        'pagina': pagina,
+        'consulta': consulta,
+    }
+    return render(request, 'historial.html', contexto)
+
+
+# Flujo SSE con los cambios de citas. Es una vista asincrona: bajo ASGI cada
+# conexion es solo una corrutina esperando en su cola, sin hilos ni consultas.
+@login_required
+async def eventos_citas(request):
+    # Bajo WSGI Django juntaria el flujo infinito en memoria y bloquearia un
+    # hilo por pestaña: se responde 204, que hace que EventSource no reintente.
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+
+    user = await request.auser()
+
+    filtro = None
+    if not user.is_staff:
+        paciente = await Paciente.objects.filter(user=user).afirst()
+        if paciente is None:
+            return HttpResponseForbidden()
+        filtro = lambda evento: evento.get('paciente_id') in (None, paciente.id)
+
+    async def flujo():
+        suscripcion = difusor.suscribir(filtro)
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    evento = await asyncio.wait_for(suscripcion.cola.get(), INTERVALO_LATIDO)
+                except asyncio.TimeoutError:
+                    # Comentario SSE para mantener viva la conexion en proxies.
+                    yield ': latido\n\n'
+                    continue
+                yield f"event: cita\ndata: {json.dumps(evento)}\n\n"
+        finally:
+            difusor.desuscribir(suscripcion)
+
+    response = StreamingHttpResponse(flujo(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# Descarga del historial de citas en CSV comprimido (?desde=ISO para solo lo
+# modificado desde esa fecha). Se genera por lotes mientras se envia.
+@login_required
+async def exportar_citas(request):
+    user = await request.auser()
+    if not user.is_staff:
+        return HttpResponseForbidden()
+
+    desde = None
+    if request.GET.get('desde'):
+        desde = exportacion.fecha_con_zona(parse_datetime(request.GET['desde']))
+        if desde is None:
+            return HttpResponse("Fecha inválida en 'desde'.", status=400)
+
+    async def flujo():
+        compresor = exportacion.compresor_gzip()
+        yield compresor.compress(exportacion.csv_de_lote([], encabezado=True).encode('utf-8'))
+        cursor = None
+        while True:
+            lote, cursor = await sync_to_async(exportacion.leer_lote)(desde, cursor)
+            if not lote:
+                break
+            parte = compresor.compress(exportacion.csv_de_lote(lote).encode('utf-8'))
+            if parte:
+                yield parte
+        yield compresor.flush()
+
+    # Bajo WSGI Django juntaria un iterador async completo en memoria antes de
+    # enviarlo; ahi se usa un generador sincrono, que se envia lote a lote.
+    if isinstance(request, ASGIRequest):
+        contenido = flujo()
+    else:
+        contenido = exportacion.csv_gzip(exportacion.iterar_lotes(desde))
+
+    response = StreamingHttpResponse(contenido, content_type='application/gzip')
+    response['Content-Disposition'] = 'attachment; filename="citas.csv.gz"'
+    return response
+
+
 @login_required
 def generar_usuarios_aleatorios(request):
     if not request.user.is_staff:
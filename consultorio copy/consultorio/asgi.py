@@ -3,6 +3,9 @@ ASGI config for consultorio project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The live agenda feed (``/eventos/citas/``) is an async streaming view and needs
+to be served through this entry point, e.g. ``uvicorn consultorio.asgi:application``.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """